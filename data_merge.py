@@ -6,6 +6,7 @@ from datetime import datetime
 from datetime import timedelta
 from datetime import date
 import traceback
+import hashlib
 import logging
 import shutil
 import numpy as np
@@ -135,10 +136,17 @@ def calculate_net_received_amount(df):
     return df
 
 
-def remove_cancelled_sales(df, cancelled_path, dtypes):
+def remove_cancelled_sales(df):
     exclude_list = ['cancelled', 'rejected', 'pending']
     cancelled_filter = df['status'].isin(exclude_list)
     cancelled_df = df[cancelled_filter]
+
+    # main_df without cancelled and rejected sales
+    df = df[~cancelled_filter]
+    return df, cancelled_df
+
+
+def add_cancelled_sales(cancelled_df, cancelled_path, dtypes):
     if os.path.isfile(cancelled_path):
         logger.debug('Opening historical data of cancelled sales')
         cancelled_historical = open_excel(cancelled_path, dtypes=dtypes)
@@ -152,12 +160,10 @@ def remove_cancelled_sales(df, cancelled_path, dtypes):
                                                      'SOURCE_ID', 'transaction_amount', 'taxes_amount', 'pack_id',
                                                      'shipping_cost_by_customer'])
 
+    # Skipping the cancelled sales already saved by a previous run over the same input files
+    cancelled_df = indentify_new_sales(cancelled_historical, cancelled_df, 'operation_id', 'operation_id')
     cancelled_data = pd.concat([cancelled_historical, cancelled_df], axis=0).reset_index(drop=True)
-    cancelled_data.to_excel(cancelled_path, index=False, sheet_name='cancelled')
-
-    # main_df without cancelled and rejected sales
-    df = df[~cancelled_filter]
-    return df
+    return cancelled_data
 
 
 def add_refunded_sales(df, refund_df):
@@ -310,15 +316,146 @@ def data_aggregation(df):
     return df
 
 
-def add_product_cost(main_df, cost_df):
-    main_df = main_df.merge(right=cost_df,
-                            how='left',
-                            left_on='item_id',
-                            right_on='# Publicacion')
-    df_filter = main_df['date_created'] >= date(2023, 6, 1)
-    main_df.loc[df_filter, 'product_cost'] = main_df.loc[df_filter, 'quantity'] * main_df.loc[df_filter, 'Total costo COP']
-    main_df.drop(columns=['# Publicacion', 'Total costo COP'], inplace=True)
-    return main_df
+def open_cost_history(cost_history_path):
+    if os.path.isfile(cost_history_path):
+        logger.debug('Opening historical data of product costs')
+        cost_history = open_excel(cost_history_path, dtypes={'# Publicacion': str})
+        cost_history['effective_date'] = pd.to_datetime(cost_history['effective_date']).dt.date
+    else:
+        cost_history = pd.DataFrame(columns=['# Publicacion', 'Total costo COP', 'effective_date'])
+    return cost_history
+
+
+def seed_cost_history(main_df):
+    # The unit costs already stored in the historical sales start the cost history, so the first cost file does not
+    # reprice the sales that already have a cost
+    seed_cols = ['# Publicacion', 'Total costo COP', 'effective_date']
+    if 'product_cost' not in main_df.columns:
+        return pd.DataFrame(columns=seed_cols)
+    seed_filter = (~main_df['product_cost'].isnull()) & (main_df['quantity'] != 0)
+    seed = main_df.loc[seed_filter, ['item_id', 'date_created', 'product_cost', 'quantity']].copy()
+    seed['# Publicacion'] = seed['item_id']
+    seed['Total costo COP'] = seed['product_cost'] / seed['quantity']
+    seed['effective_date'] = pd.to_datetime(seed['date_created']).dt.date
+    seed.sort_values(by=['# Publicacion', 'effective_date'], kind='stable', inplace=True)
+    seed.drop_duplicates(subset=['# Publicacion', 'effective_date'], keep='last', inplace=True)
+    # Only the dates in which the cost of an item changed are needed
+    seed = seed[seed.groupby('# Publicacion')['Total costo COP'].diff() != 0]
+    return seed[seed_cols].reset_index(drop=True)
+
+
+def load_cost_history(cost_history_path, historical_df):
+    cost_history = open_cost_history(cost_history_path)
+    if len(cost_history) == 0:
+        logger.debug('Seeding the product costs history from the historical data')
+        cost_history = seed_cost_history(historical_df)
+    return cost_history
+
+
+def update_cost_history(cost_history, cost_df, batch_start_date):
+    # The costs of a file without a date in its name apply from the earliest sale of the batch being loaded, so the
+    # batch gets the costs loaded with it. The first cost file applies from the date the costs started to be tracked
+    if len(cost_history) == 0:
+        default_date = date(2023, 6, 1)
+    else:
+        default_date = batch_start_date
+    cost_df = cost_df.copy()
+    cost_df['effective_date'] = cost_df['effective_date'].fillna(default_date)
+    # Loading a cost file again for the same effective date replaces the previous version of it. The load order keeps
+    # the latest version last because the sort is stable
+    cost_history = pd.concat([cost_history.assign(load_order=0), cost_df.assign(load_order=1)], axis=0)
+    cost_history.sort_values(by=['effective_date', 'load_order'], kind='stable', inplace=True)
+    cost_history.drop_duplicates(subset=['# Publicacion', 'effective_date'], keep='last', inplace=True,
+                                 ignore_index=True)
+    cost_history.drop(columns=['load_order'], inplace=True)
+    return cost_history
+
+
+def add_product_cost(main_df, cost_history):
+    # As-of join: each sale gets the cost of its item that was in effect on the sale date
+    main_df = main_df.rename(columns={'product_cost': 'previous_product_cost'}).reset_index(drop=True)
+    main_df['row_order'] = main_df.index
+    main_df['sale_date'] = pd.to_datetime(main_df['date_created']).astype('datetime64[ns]')
+    cost_history = cost_history.loc[:, ['# Publicacion', 'Total costo COP', 'effective_date']]
+    cost_history['effective_date'] = pd.to_datetime(cost_history['effective_date']).astype('datetime64[ns]')
+    if cost_history['effective_date'].isnull().any():
+        logger.warning(f'Dropping {cost_history["effective_date"].isnull().sum()} product costs without effective date')
+        cost_history = cost_history[~cost_history['effective_date'].isnull()]
+    cost_history['# Publicacion'] = cost_history['# Publicacion'].astype(main_df['item_id'].dtype)
+    main_df = pd.merge_asof(main_df.sort_values(by='sale_date'),
+                            cost_history.sort_values(by='effective_date'),
+                            left_on='sale_date',
+                            right_on='effective_date',
+                            left_by='item_id',
+                            right_by='# Publicacion',
+                            direction='backward')
+    main_df['product_cost'] = main_df['quantity'] * main_df['Total costo COP']
+    if 'previous_product_cost' in main_df.columns:
+        # The sales without a cost in the history keep the cost they already had
+        main_df['product_cost'] = main_df['product_cost'].fillna(main_df['previous_product_cost'])
+        main_df.drop(columns=['previous_product_cost'], inplace=True)
+    main_df.sort_values(by='row_order', inplace=True)
+    main_df.drop(columns=['# Publicacion', 'Total costo COP', 'effective_date', 'sale_date', 'row_order'],
+                 inplace=True)
+    return main_df.reset_index(drop=True)
+
+
+def get_product_cost_rows(df, columns):
+    # Product cost rows of the consolidated data, built the same way as in generate_aux_data
+    cost_rows = df.rename(columns={'product_cost': 'amount'})
+    cost_rows['transaction_type'] = 'product_cost'
+    cost_rows = cost_rows[cost_rows['amount'] != 0]
+    return cost_rows[columns]
+
+
+def recompute_product_cost(main_data, consolidated_data, cost_history):
+    # The product costs of the whole history are recomputed in a single pass and the product cost rows of the
+    # consolidated data are rebuilt from them
+    logger.debug('Recomputing the product costs of the historical data')
+    main_data = add_product_cost(main_data, cost_history)
+    consolidated_data = consolidated_data[consolidated_data['transaction_type'] != 'product_cost']
+    consolidated_data = pd.concat([consolidated_data,
+                                   get_product_cost_rows(main_data, consolidated_data.columns.tolist())],
+                                  axis=0).reset_index(drop=True)
+    return main_data, consolidated_data
+
+
+def open_consolidated_data(consolidated_path, dtypes):
+    if os.path.isfile(consolidated_path):
+        historical_consolidated = open_excel(consolidated_path, dtypes=dtypes)
+    else:
+        historical_consolidated = pd.DataFrame(columns=['date_created', 'item_id', 'reason',
+                                                        'external_reference', 'SKU', 'operation_id',
+                                                        'status', 'status_detail', 'operation_type',
+                                                        'amount', 'payment_type', 'order_id',
+                                                        'shipment_status', 'time_created', 'file_date',
+                                                        'quantity', 'transaction_type', 'marketplace',
+                                                        'pack_id'
+                                                        ])
+    return historical_consolidated
+
+
+def save_cost_history(state, historical_df, historical_path, consolidated_path, cost_history_path, dtypes):
+    # Storing new cost files loaded in a run without new sales and repricing the historical data with them
+    cost_history = load_cost_history(cost_history_path, historical_df)
+    # With no new sales, the costs of a file without date apply from the day after the latest sale already saved
+    if len(historical_df) > 0:
+        batch_start_date = (pd.to_datetime(historical_df['date_created']).max() + timedelta(days=1)).date()
+    else:
+        batch_start_date = date.today()
+    cost_history = update_cost_history(cost_history, state['cost_df'], batch_start_date)
+    files = [(cost_history, cost_history_path, 'costs')]
+    if len(historical_df) > 0:
+        main_data, consolidated_data = recompute_product_cost(historical_df,
+                                                              open_consolidated_data(consolidated_path, dtypes),
+                                                              cost_history)
+        files = [(main_data, historical_path, 'main'),
+                 (consolidated_data, consolidated_path, 'consolidated')] + files
+    logger.debug('Saving product costs files...')
+    save_excel_files(files)
+    logger.debug('Saving product costs files process finished')
+    state['costs_saved'] = True
+    return state
 
 
 def import_file(file, files_names_start_list, input_files_path, dtypes=None):
@@ -361,6 +498,277 @@ def remove_duplicates(df, sort_by, rm_cols=None, subset=None):
     return df
 
 
+def get_run_id(input_files_path, files):
+    # The run id identifies the set of input files, so a rerun over the same inputs resumes the same run
+    run_hash = hashlib.sha1()
+    for file in sorted(files):
+        file_stat = os.stat(os.path.join(input_files_path, file))
+        run_hash.update(f'{file}|{file_stat.st_size}|{file_stat.st_mtime_ns}'.encode('utf-8'))
+    return run_hash.hexdigest()[:16]
+
+
+def get_checkpoint_file(checkpoint_path, run_id, stage):
+    return os.path.join(checkpoint_path, run_id, f'{stage}.pkl')
+
+
+def save_checkpoint(checkpoint_path, run_id, stage, state):
+    run_folder_path = os.path.join(checkpoint_path, run_id)
+    if not os.path.isdir(run_folder_path):
+        os.makedirs(run_folder_path)
+    checkpoint_file = get_checkpoint_file(checkpoint_path, run_id, stage)
+    # Writing to a temporary file first so an interrupted write never leaves a corrupt checkpoint behind
+    pd.to_pickle(state, checkpoint_file + '.tmp')
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def load_checkpoint(checkpoint_path, run_id, stage):
+    return pd.read_pickle(get_checkpoint_file(checkpoint_path, run_id, stage))
+
+
+def find_last_checkpoint(checkpoint_path, run_id, stages):
+    for stage in reversed(stages):
+        if os.path.isfile(get_checkpoint_file(checkpoint_path, run_id, stage)):
+            return stage
+    return None
+
+
+def clear_checkpoints(checkpoint_path):
+    # Removing the checkpoints of every run, including the ones left by failed runs over other input files
+    if os.path.isdir(checkpoint_path):
+        shutil.rmtree(checkpoint_path)
+
+
+def save_excel_files(files):
+    # Every file is written to a temporary file first and they are only replaced once all the writes succeeded,
+    # so a failed save never leaves part of the outputs updated
+    temp_paths = []
+    try:
+        for df, excel_path, sheet_name in files:
+            temp_path = os.path.splitext(excel_path)[0] + '.tmp.xlsx'
+            temp_paths.append((temp_path, excel_path))
+            df.to_excel(temp_path, index=False, sheet_name=sheet_name)
+        for temp_path, excel_path in temp_paths:
+            os.replace(temp_path, excel_path)
+    finally:
+        # Removing the temporary files that were not moved into place
+        for temp_path, _ in temp_paths:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+
+def run_stages(state, stages, checkpoint_path, run_id):
+    # Running each stage and persisting its output so a failed run can resume from the last good stage
+    for stage, stage_func in stages:
+        logger.debug(f'Running stage "{stage}"')
+        state = stage_func(state)
+        save_checkpoint(checkpoint_path, run_id, stage, state)
+    return state
+
+
+def parse_input_files(files_to_load, files_names_start_list, input_files_path, historical_df, month_dict):
+    state = {'files_to_archive': {'sales': [], 'cost': [], 'inventory': []}, 'failed_files': []}
+    for file in files_to_load:
+        logger.debug(f'Processing {file} file')
+        archive = None
+        try:
+            # Assigning the temp dataframe to the corresponding dataframe considering the filename
+            if file.startswith(files_names_start_list[0]):
+                dtypes = {'Identificador de producto (item_id)': str,
+                          'Código de referencia (external_reference)': str,
+                          'Número de operación de Mercado Pago (operation_id)': str,
+                          'Número de venta en Mercado Libre (order_id)': str
+                          }
+                file_date = datetime.strptime(re.findall(r'-([0-9]{14})-', file)[0], '%Y%m%d%H%M%S')
+                date_str = file_date.strftime('%Y%m%d')
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                temp = indentify_new_sales(historical_df, temp, 'external_reference',
+                                           'Código de referencia (external_reference)')
+                if 'activities_collection' not in state:
+                    state['activities_collection'] = get_activities_df(temp, file_date)
+                else:
+                    state['activities_collection'] = pd.concat([state['activities_collection'],
+                                                                get_activities_df(temp, file_date)], axis=0)
+                archive = 'sales'
+            elif file.startswith(files_names_start_list[1]):
+                dtypes = {'SOURCE_ID': str,
+                          'EXTERNAL_REFERENCE': str,
+                          'ORDER_ID': str,
+                          'PACK_ID': str
+                          }
+                file_date = datetime.strptime(''.join(re.findall(r'-([0-9]{4})-([0-9]{2})-([0-9]{1,2})', file)[0]),
+                                              '%Y%m%d')
+                date_str = file_date.strftime('%Y%m%d')
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                temp['file_date'] = file_date.date()
+                if 'settlement_report' not in state:
+                    state['settlement_report'] = temp
+                else:
+                    state['settlement_report'] = pd.concat([state['settlement_report'], temp], axis=0)
+                archive = 'sales'
+            elif file.startswith(files_names_start_list[2]):
+                dtypes = {'ID de publicación': str}
+                date_str = datetime.strptime(''.join(re.findall(r'_([0-9]{1,2})-([0-9]{2})-([0-9]{4})_', file)[0]),
+                                             '%d%m%Y').strftime('%Y%m%d')
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                temp.rename(columns={'Código ML': 'ml_code', 'ID de publicación': 'MCO'}, inplace=True)
+                state['stock_general_full'] = temp
+                archive = 'inventory'
+            elif file.startswith(files_names_start_list[3]):
+                dtypes = {'# de venta': str,
+                          '# de publicación': str}
+                date_str = re.findall(r'_([0-9]{1,2})_de_([a-z]{3,10})_de_([0-9]{4})', file)[0]
+                date_str = datetime.strptime(date_str[2]+month_dict[date_str[1]]+date_str[0], '%Y%m%d').strftime('%Y%m%d')
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                cols = ['# de venta', 'Fecha de venta', 'Estado', 'Unidades', 'Ingresos por productos (COP)',
+                        'Ingresos por envío (COP)', 'Cargo por venta e impuestos', 'Costos de envío',
+                        'Anulaciones y reembolsos (COP)', 'Total (COP)', 'SKU',
+                        '# de publicación', 'Canal de venta', 'Título de la publicación', 'Variante',
+                        'Precio unitario de venta de la publicación (COP)', 'Tipo de publicación']
+                temp = temp[cols]
+                if 'ventas_co' not in state:
+                    state['ventas_co'] = temp
+                else:
+                    state['ventas_co'] = pd.concat([state['ventas_co'], temp], axis=0)
+                archive = 'sales'
+            elif file.startswith(files_names_start_list[4]):
+                dtypes = {'CÓD ML / SKU': str,
+                          '# Publicacion': str}
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                temp = temp[['CÓD ML / SKU', '# Publicacion', 'Provider', 'Title', 'Referencia',
+                             'Detalle', 'Estado', 'Inventario CASA']]
+                temp.rename(columns={'CÓD ML / SKU': 'SKU'}, inplace=True)
+                state['stock_casa_df'] = temp
+            elif file.startswith(files_names_start_list[5]):
+                dtypes = {'# Publicacion': str}
+                # The effective date of the costs comes in the file name when available
+                effective_date = re.findall(r'([0-9]{4})-([0-9]{2})-([0-9]{2})', file)
+                if len(effective_date) > 0:
+                    effective_date = datetime.strptime(''.join(effective_date[0]), '%Y%m%d').date()
+                    date_str = effective_date.strftime('%Y%m%d')
+                else:
+                    effective_date = None
+                    date_str = datetime.now().strftime('%Y%m%d')
+                temp = import_file(file, files_names_start_list, input_files_path, dtypes)
+                cols = ['# Publicacion', 'Total costo COP']
+                temp = temp[cols]
+                temp['effective_date'] = effective_date
+                if 'cost_df' not in state:
+                    state['cost_df'] = temp
+                else:
+                    state['cost_df'] = pd.concat([state['cost_df'], temp], axis=0)
+                archive = 'cost'
+
+            # The files are moved to the archive only once the data they belong to is saved, except for the house
+            # inventory file. The cost files are archived once they are stored in the cost history
+            if archive is not None:
+                state['files_to_archive'][archive].append((file, date_str))
+
+        except Exception as ex:
+            logger.error(ex)
+            logger.error(traceback.format_exc())
+            state['failed_files'].append(file)
+    return state
+
+
+def stage_remove_duplicates(state):
+    state['activities_collection'] = remove_duplicates(state['activities_collection'],
+                                                       sort_by=['date_created', 'file_date'],
+                                                       rm_cols=['file_date'])
+    state['settlement_report'] = remove_duplicates(state['settlement_report'],
+                                                   sort_by=['ORIGIN_DATE', 'file_date'],
+                                                   rm_cols=['file_date'])
+    state['ventas_co'] = remove_duplicates(state['ventas_co'],
+                                           sort_by=['# de venta'],
+                                           subset=['# de venta'])
+    return state
+
+
+def stage_populate_missing_fields(state):
+    state['activities_collection'], state['refunded_sales'] = populate_missing_fields(
+        state['activities_collection'], state['settlement_report'])
+    return state
+
+
+def stage_calculate_amounts(state):
+    state['activities_collection'] = add_shipping_cost_by_customer(state['activities_collection'])
+    state['activities_collection'] = calculate_net_received_amount(state['activities_collection'])
+    return state
+
+
+def stage_remove_cancelled_sales(state):
+    state['activities_collection'], state['cancelled_sales'] = remove_cancelled_sales(state['activities_collection'])
+    return state
+
+
+def stage_add_refunded_sales(state):
+    state['activities_collection'] = add_refunded_sales(state['activities_collection'], state['refunded_sales'])
+    return state
+
+
+def stage_add_quantities_marketplace(state):
+    state['activities_collection'] = add_quantities_marketplace(state['activities_collection'], state['ventas_co'])
+    return state
+
+
+def stage_fix_refunded_sales(state):
+    state['activities_collection'] = fix_refunded_sales(state['activities_collection'])
+    return state
+
+
+def stage_data_aggregation(state):
+    state['activities_collection'] = data_aggregation(state['activities_collection'])
+    state['activities_collection']['item_id'] = state['activities_collection']['item_id'].apply(
+        lambda x: str(x).strip('MCO'))
+    return state
+
+
+def stage_add_product_cost(state, cost_history_path, historical_df):
+    state['cost_history'] = load_cost_history(cost_history_path, historical_df)
+    if 'cost_df' in state:
+        state['cost_history'] = update_cost_history(state['cost_history'], state['cost_df'],
+                                                    state['activities_collection']['date_created'].min())
+    state['activities_collection'] = add_product_cost(state['activities_collection'], state['cost_history'])
+    return state
+
+
+def stage_generate_aux_data(state):
+    state['aux_data'] = generate_aux_data(state['activities_collection'])
+    return state
+
+
+def stage_save_sales_data(state, historical_df, historical_path, consolidated_path, cancelled_path, cost_history_path,
+                          dtypes):
+    # Skipping the sales already saved, in case the files were written but the stage was not checkpointed
+    activities_collection = indentify_new_sales(historical_df, state['activities_collection'], 'external_reference',
+                                                'external_reference')
+    aux_data = indentify_new_sales(historical_df, state['aux_data'], 'external_reference', 'external_reference')
+    # Re-ordering de columns before concatenating it with the historical data
+    activities_collection = activities_collection[historical_df.columns.tolist()]
+    # Assigning the dtypes from activities_collection to the historical df
+    historical_df = historical_df.astype(activities_collection.dtypes)
+    # Inserting new sales into the historical data files
+    main_data = pd.concat([historical_df, activities_collection], axis=0).reset_index(drop=True)
+    historical_consolidated = open_consolidated_data(consolidated_path, dtypes)
+    aux_data = aux_data[historical_consolidated.columns.tolist()]
+    historical_consolidated = historical_consolidated.astype(aux_data.dtypes)
+    consolidated_data = pd.concat([historical_consolidated, aux_data], axis=0).reset_index(drop=True)
+    if 'cost_df' in state:
+        # New costs were loaded, so the product costs of the whole history are recomputed
+        main_data, consolidated_data = recompute_product_cost(main_data, consolidated_data, state['cost_history'])
+    cancelled_data = add_cancelled_sales(state['cancelled_sales'], cancelled_path, dtypes)
+    # Saving the files with the new data added
+    logger.debug('Saving sales files...')
+    save_excel_files([(main_data, historical_path, 'main'),
+                      (consolidated_data, consolidated_path, 'consolidated'),
+                      (cancelled_data, cancelled_path, 'cancelled'),
+                      (state['cost_history'], cost_history_path, 'costs')])
+    logger.debug('Saving sales files process finished')
+    state['sales_saved'] = True
+    if 'cost_df' in state:
+        state['costs_saved'] = True
+    return state
+
+
 def main():
     logger.info('Start data processing program')
     data_folder = 'BI'
@@ -368,26 +776,20 @@ def main():
     consolidated_file = 'consolidated_data.xlsx'
     cancelled_file = 'cancelled_sales.xlsx'
     inventory_file = 'total_inventory.xlsx'
+    cost_history_file = 'product_costs.xlsx'
     archive_data = 'Archive'
+    checkpoint_data = 'checkpoints'
     working_path = os.getcwd()
     input_files_path = os.path.join(working_path, data_folder)
     archive_path = os.path.join(input_files_path, archive_data)
+    checkpoint_path = os.path.join(working_path, checkpoint_data)
     historical_path = os.path.join(working_path, main_data_file)
     consolidated_path = os.path.join(working_path, consolidated_file)
     cancelled_path = os.path.join(working_path, cancelled_file)
     inventory_path = os.path.join(working_path, inventory_file)
-    c_activities = 0
-    c_settle = 0
-    c_sales = 0
+    cost_history_path = os.path.join(working_path, cost_history_file)
     days_of_sales = 30
     order_lead_time = 20
-    activities = False
-    ventas = False
-    settlement = False
-    stock_casa = False
-    stock_full = False
-    cost = False
-    archive = False
 
     month_dict = {
         'enero': '01',
@@ -438,172 +840,61 @@ def main():
                                                   'shipping_cost_by_seller', 'shipping_cost_by_customer',
                                                   'coupon_fee', 'taxes_amount', 'net_received_amount', 'payment_type',
                                                   'amount_refunded', 'order_id', 'shipment_status', 'time_created',
-                                                  'file_date', 'quantity', 'marketplace', 'pack_id', 'cost'])
-        for file in files_to_load:
-            logger.debug(f'Processing {file} file')
-            try:
-                # Assigning the temp dataframe to the corresponding dataframe considering the filename
-                if file.startswith(files_names_start_list[0]):
-                    dtypes = {'Identificador de producto (item_id)': str,
-                              'Código de referencia (external_reference)': str,
-                              'Número de operación de Mercado Pago (operation_id)': str,
-                              'Número de venta en Mercado Libre (order_id)': str
-                              }
-                    file_date = datetime.strptime(re.findall(r'-([0-9]{14})-', file)[0], '%Y%m%d%H%M%S')
-                    date_str = file_date.strftime('%Y%m%d')
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    temp = indentify_new_sales(historical_df, temp, 'external_reference',
-                                               'Código de referencia (external_reference)')
-                    if c_activities == 0:
-                        activities_collection = get_activities_df(temp, file_date)
-                    else:
-                        activities_collection = pd.concat([activities_collection, get_activities_df(temp, file_date)],
-                                                          axis=0)
-                    c_activities += 1
-                    activities = True
-                    archive = True
-                elif file.startswith(files_names_start_list[1]):
-                    dtypes = {'SOURCE_ID': str,
-                              'EXTERNAL_REFERENCE': str,
-                              'ORDER_ID': str,
-                              'PACK_ID': str
-                              }
-                    file_date = datetime.strptime(''.join(re.findall(r'-([0-9]{4})-([0-9]{2})-([0-9]{1,2})', file)[0]),
-                                                  '%Y%m%d')
-                    date_str = file_date.strftime('%Y%m%d')
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    temp['file_date'] = file_date.date()
-                    if c_settle == 0:
-                        settlement_report = temp
-                    else:
-                        settlement_report = pd.concat([settlement_report, temp], axis=0)
-                    c_settle += 1
-                    settlement = True
-                    archive = True
-                elif file.startswith(files_names_start_list[2]):
-                    dtypes = {'ID de publicación': str}
-                    date_str = datetime.strptime(''.join(re.findall(r'_([0-9]{1,2})-([0-9]{2})-([0-9]{4})_', file)[0]),
-                                             '%d%m%Y').strftime('%Y%m%d')
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    temp.rename(columns={'Código ML': 'ml_code', 'ID de publicación': 'MCO'}, inplace=True)
-                    stock_general_full = temp
-                    stock_full = True
-                    archive = True
-                elif file.startswith(files_names_start_list[3]):
-                    dtypes = {'# de venta': str,
-                              '# de publicación': str}
-                    date_str = re.findall(r'_([0-9]{1,2})_de_([a-z]{3,10})_de_([0-9]{4})', file)[0]
-                    date_str = datetime.strptime(date_str[2]+month_dict[date_str[1]]+date_str[0], '%Y%m%d').strftime('%Y%m%d')
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    cols = ['# de venta', 'Fecha de venta', 'Estado', 'Unidades', 'Ingresos por productos (COP)',
-                            'Ingresos por envío (COP)', 'Cargo por venta e impuestos', 'Costos de envío',
-                            'Anulaciones y reembolsos (COP)', 'Total (COP)', 'SKU',
-                            '# de publicación', 'Canal de venta', 'Título de la publicación', 'Variante',
-                            'Precio unitario de venta de la publicación (COP)', 'Tipo de publicación']
-                    temp = temp[cols]
-                    if c_sales == 0:
-                        ventas_co = temp
-                    else:
-                        ventas_co = pd.concat([ventas_co, temp], axis=0)
-                    c_sales += 1
-                    ventas = True
-                    archive = True
-                elif file.startswith(files_names_start_list[4]):
-                    dtypes = {'CÓD ML / SKU': str,
-                              '# Publicacion': str}
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    temp = temp[['CÓD ML / SKU', '# Publicacion', 'Provider', 'Title', 'Referencia',
-                                 'Detalle', 'Estado', 'Inventario CASA']]
-                    temp.rename(columns={'CÓD ML / SKU': 'SKU'}, inplace=True)
-                    stock_casa_df = temp
-                    stock_casa = True
-                    archive = False
-                elif file.startswith(files_names_start_list[5]):
-                    dtypes = {'# Publicacion': str}
-                    temp = import_file(file, files_names_start_list, input_files_path, dtypes)
-                    cols = ['# Publicacion', 'Total costo COP']
-                    temp = temp[cols]
-                    cost_df = temp
-                    cost = True
-                    archive = False
-
-                # Moving the current file to an archive except for the house inventory file
-                if archive:
-                    logger.debug(f'Moving the file {file} to the archive')
-                    do_archive(input_files_path, archive_path, date_str, file)
-
-            except Exception as ex:
-                logger.error(ex)
-                logger.error(traceback.format_exc())
+                                                  'file_date', 'quantity', 'marketplace', 'pack_id', 'product_cost'])
+
+        # Sales pipeline stages, each one is checkpointed under the run id once it finishes
+        sales_stages = [
+            ('remove_duplicates', stage_remove_duplicates),
+            ('populate_missing_fields', stage_populate_missing_fields),
+            ('calculate_amounts', stage_calculate_amounts),
+            ('remove_cancelled_sales', stage_remove_cancelled_sales),
+            ('add_refunded_sales', stage_add_refunded_sales),
+            ('add_quantities_marketplace', stage_add_quantities_marketplace),
+            ('fix_refunded_sales', stage_fix_refunded_sales),
+            ('data_aggregation', stage_data_aggregation),
+            ('add_product_cost', lambda state: stage_add_product_cost(state, cost_history_path, historical_df)),
+            ('generate_aux_data', stage_generate_aux_data),
+            ('save_sales_data',
+             lambda state: stage_save_sales_data(state, historical_df, historical_path, consolidated_path,
+                                                 cancelled_path, cost_history_path, main_dtypes))
+        ]
+        stage_names = ['parse_input_files'] + [stage for stage, _ in sales_stages]
 
         try:
-            logger.debug(f'There are {len(activities_collection)} records to be added')
-            if len(activities_collection) > 0:
-                if activities and settlement and ventas and cost:
-                    logger.debug('Removing duplicates from the main files')
-                    activities_collection = remove_duplicates(activities_collection,
-                                                              sort_by=['date_created', 'file_date'],
-                                                              rm_cols=['file_date'])
-                    settlement_report = remove_duplicates(settlement_report,
-                                                          sort_by=['ORIGIN_DATE', 'file_date'],
-                                                          rm_cols=['file_date'])
-                    ventas_co = remove_duplicates(ventas_co,
-                                                  sort_by=['# de venta'],
-                                                  subset=['# de venta'])
-                    logger.debug('Populating the missing marketplace fees')
-                    activities_collection, refunded_sales = populate_missing_fields(activities_collection, settlement_report)
-                    logger.debug('Adding Shipping cost by customer')
-                    activities_collection = add_shipping_cost_by_customer(activities_collection)
-                    logger.debug('Recalculating Net received amount')
-                    activities_collection = calculate_net_received_amount(activities_collection)
-                    logger.debug('Removing Cancelled sales')
-                    activities_collection = remove_cancelled_sales(activities_collection, cancelled_path, main_dtypes)
-                    logger.debug('concatenating main and refunded data')
-                    activities_collection = add_refunded_sales(activities_collection, refunded_sales)
-                    logger.debug('Adding the marketplace and the quantities sold for each product')
-                    activities_collection = add_quantities_marketplace(activities_collection, ventas_co)
-                    logger.debug('Fixing the refunded values')
-                    activities_collection = fix_refunded_sales(activities_collection)
-                    logger.debug('Grouping and aggregating the main data')
-                    activities_collection = data_aggregation(activities_collection)
-                    activities_collection['item_id'] = activities_collection['item_id'].apply(lambda x: str(x).strip('MCO'))
-                    logger.debug('Adding the cost of the products')
-                    activities_collection = add_product_cost(activities_collection, cost_df)
-                    logger.debug('Generating Auxiliary File')
-                    aux_data = generate_aux_data(activities_collection)
-
-                    # Re-ordering de columns before concatenating it with the historical data
-                    activities_collection = activities_collection[historical_df.columns.tolist()]
-                    # Assigning the dtypes from activities_collection to the historical df
-                    historical_df = historical_df.astype(activities_collection.dtypes)
-                    # Inserting new sales into the historical data files
-                    main_data = pd.concat([historical_df, activities_collection], axis=0).reset_index(drop=True)
-                    if os.path.isfile(consolidated_path):
-                        historical_consolidated = open_excel(consolidated_path, dtypes=main_dtypes)
-                    else:
-                        historical_consolidated = pd.DataFrame(columns=['date_created', 'item_id', 'reason',
-                                                                        'external_reference', 'SKU', 'operation_id',
-                                                                        'status', 'status_detail', 'operation_type',
-                                                                        'amount', 'payment_type', 'order_id',
-                                                                        'shipment_status', 'time_created', 'file_date',
-                                                                        'quantity', 'transaction_type', 'marketplace',
-                                                                        'pack_id'
-                                                                        ])
-                    aux_data = aux_data[historical_consolidated.columns.tolist()]
-                    historical_consolidated = historical_consolidated.astype(aux_data.dtypes)
-                    consolidated_data = pd.concat([historical_consolidated, aux_data], axis=0).reset_index(drop=True)
-                    # Saving the files with the new data added
-                    logger.debug('Saving sales files...')
-                    main_data.to_excel(historical_path, index=False, sheet_name='main')
-                    consolidated_data.to_excel('consolidated_data.xlsx', index=False, sheet_name='consolidated')
-                    logger.debug('Saving sales files process finished')
+            run_id = get_run_id(input_files_path, files_to_load)
+            last_stage = find_last_checkpoint(checkpoint_path, run_id, stage_names)
+            if last_stage is None:
+                state = parse_input_files(files_to_load, files_names_start_list, input_files_path, historical_df,
+                                          month_dict)
+                if len(state['failed_files']) > 0:
+                    # Nothing is checkpointed nor archived, so the next run parses all the input files again
+                    raise RuntimeError(f'Some input files could not be loaded: {state["failed_files"]}')
+                save_checkpoint(checkpoint_path, run_id, 'parse_input_files', state)
+            else:
+                logger.info(f'Resuming run {run_id} from the checkpoint of stage "{last_stage}"')
+                state = load_checkpoint(checkpoint_path, run_id, last_stage)
+            # Only the stages after the last checkpointed one are pending
+            pending_stages = sales_stages[stage_names.index(last_stage or 'parse_input_files'):]
+
+            if 'activities_collection' in state and len(state['activities_collection']) > 0:
+                logger.debug(f'There are {len(state["activities_collection"])} records to be added')
+                if all(key in state for key in ['activities_collection', 'settlement_report', 'ventas_co']) and \
+                        ('cost_df' in state or os.path.isfile(cost_history_path)):
+                    state = run_stages(state, pending_stages, checkpoint_path, run_id)
                 else:
                     logger.info('Some of the sales data are missing in the input files path')
             else:
                 logger.info('There is no new data to add')
 
-            if stock_casa and stock_full:
+            if 'cost_df' in state and not state.get('costs_saved'):
+                logger.debug('Adding the new product costs to the history')
+                state = save_cost_history(state, historical_df, historical_path, consolidated_path, cost_history_path,
+                                          main_dtypes)
+
+            if 'stock_casa_df' in state and 'stock_general_full' in state:
                 logger.debug('Processing inventory files')
+                stock_casa_df = state['stock_casa_df']
+                stock_general_full = state['stock_general_full']
                 inventory = stock_casa_df.merge(how='left',
                                                 right=stock_general_full.loc[:, ['ml_code', 'Stock total almacenado']],
                                                 left_on=['SKU'],
@@ -675,9 +966,24 @@ def main():
                 logger.debug('Saving inventory file...')
                 inventory.to_excel(inventory_path, index=False, sheet_name='inventory')
                 logger.debug('Saving inventory file process finished')
+                state['inventory_saved'] = True
             else:
                 logger.info('Some of the inventory files is missing')
 
+            # Committing the run: only the input files whose data was saved are archived, the rest stay in the input
+            # files path for the next run, and the checkpoints are no longer needed
+            files_to_archive = []
+            if state.get('sales_saved'):
+                files_to_archive += state['files_to_archive']['sales']
+            if state.get('costs_saved'):
+                files_to_archive += state['files_to_archive']['cost']
+            if state.get('inventory_saved'):
+                files_to_archive += state['files_to_archive']['inventory']
+            for file, date_str in files_to_archive:
+                logger.debug(f'Moving the file {file} to the archive')
+                do_archive(input_files_path, archive_path, date_str, file)
+            clear_checkpoints(checkpoint_path)
+
         except Exception as ex:
             logger.error(ex)
             logger.error(traceback.format_exc())